@@ -9,12 +9,12 @@ Gallery v0.2.8 — HDR badge + FS metadata overlay
 - Dedupe scan, ignore rules, MIN_LONG=1000, 4K display
 - FIXED regex for control chars (single backslashes)
 """
-import argparse, json, mimetypes, os, re, subprocess, sys, threading, time, hashlib, fnmatch
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse, atexit, functools, json, mimetypes, os, queue, re, selectors, sqlite3, subprocess, sys, tempfile, threading, time, hashlib, fnmatch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Set
-from flask import Flask, jsonify, request, send_file, abort, send_from_directory
+from flask import Flask, Response, jsonify, request, send_file, abort, send_from_directory, stream_with_context
 
 # --- Pillow / AVIF ---
 AVIF_ENABLED = False
@@ -28,12 +28,40 @@ try:
 except Exception as e:
     raise SystemExit("Pillow is required. pip install Pillow") from e
 
+# --- pyvips (optional) ---
+# libvips streams tiles and shrinks JPEGs during decode, so thumbnailing
+# cost scales with the output size rather than the source size.
+PYVIPS_ENABLED = False
+try:
+    import pyvips  # noqa: F401
+    PYVIPS_ENABLED = True
+except Exception:
+    pass
+
+# --- orjson (optional) ---
+# exiftool output is parsed as raw bytes either way; orjson is just a
+# faster parser/serializer when it happens to be installed.
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except Exception:
+    _json_loads = json.loads
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
 DEFAULT_EXTS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".heic", ".heif", ".webp", ".avif"}
 CACHE_TTL_DEFAULT = int(os.environ.get("GALLERY_CACHE_TTL", "300"))
 THUMB_SIZES = [256, 512, 1024]
 DISPLAY_MAX = int(os.environ.get("GALLERY_DISPLAY_MAX", "3840"))
-CACHE_DIR_THUMBS = Path(".cache/thumbs")
-CACHE_DIR_DISPLAY = Path(".cache/display")
+CACHE_DIR = Path(".cache")
+CACHE_DIR_THUMBS = CACHE_DIR / "thumbs"
+CACHE_DIR_DISPLAY = CACHE_DIR / "display"
+META_DB_PATH = CACHE_DIR / "meta.sqlite"
+# When set (e.g. "/_cache"), /thumb and /display answer with an
+# X-Accel-Redirect header instead of the file body, and a fronting nginx
+# serves the bytes from CACHE_DIR with sendfile — zero-copy, no Python.
+ACCEL_PREFIX = os.environ.get("GALLERY_ACCEL_PREFIX", "").rstrip("/")
 
 # --- Ignore & size rules ---
 IGNORE_DIRS = {"__MACOSX", ".cache", "thumbnails", "previews", "icons", "ui", ".git", ".svn"}
@@ -50,6 +78,11 @@ else:
 
 MIN_LONG = int(os.environ.get("GALLERY_MIN_LONG", "1000"))
 
+# Precompiled once: fnmatch re-translates each glob on every call, and the
+# scan path tests every filename against every pattern.
+_IGNORE_DIRS_LOWER = frozenset(d.lower() for d in IGNORE_DIRS)
+_IGNORE_RE = re.compile("|".join(fnmatch.translate(p.lower()) for p in IGNORE_GLOBS))
+
 # --- US State normalization (full names) ---
 US_ABBR_TO_FULL = {
     "AL":"Alabama","AK":"Alaska","AZ":"Arizona","AR":"Arkansas","CA":"California","CO":"Colorado","CT":"Connecticut","DE":"Delaware","FL":"Florida","GA":"Georgia",
@@ -62,6 +95,10 @@ US_FULL_TO_ABBR = {v.lower(): k for k, v in US_ABBR_TO_FULL.items()}
 
 app = Flask(__name__)
 
+# Resolved once; the serving routes must not re-resolve these per request.
+APP_DIR = Path(__file__).resolve().parent
+STATIC_DIR = APP_DIR / "static"
+
 def safe_float(x, default=None):
     try:
         return float(x)
@@ -69,126 +106,420 @@ def safe_float(x, default=None):
         return default
 
 # ---------------------- ExifTool wrapper --------------------
-def get_exif_metadata(file_path: str) -> dict:
-    cmd = ["exiftool","-j","-api","jsonUnicode=1","-m","-fast2","-n",file_path]
-    try:
-        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        if proc.returncode != 0:
-            app.logger.warning("[exiftool] rc=%s file=%s stderr=%s", proc.returncode, file_path, proc.stderr.strip())
+EXIFTOOL_COMMON_ARGS = ["-j", "-api", "jsonUnicode=1", "-m", "-fast2", "-n"]
+EXIFTOOL_TIMEOUT = 30  # seconds per query, daemon and batch-per-file alike
+
+class ExifToolDaemon:
+    """One long-lived `exiftool -stay_open True` process.
+
+    Spawning a fresh exiftool per file pays the Perl interpreter + module
+    load cost every time; stay_open mode spawns once and accepts commands
+    over stdin, with `{ready}` on stdout marking the end of each response.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proc: Optional[subprocess.Popen] = None
+
+    def _start(self):
+        self._proc = subprocess.Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def _kill(self):
+        if self._proc is not None:
+            try:
+                self._proc.kill()
+            except Exception:
+                pass
+            self._proc = None
+
+    def query(self, file_path: str) -> bytes:
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._start()
+            p = self._proc
+            p.stdin.write(("\n".join(EXIFTOOL_COMMON_ARGS + TAG_ARGS + [file_path, "-execute"]) + "\n").encode("utf-8"))
+            p.stdin.flush()
+            # Read with a deadline: a hang on one pathological file must not
+            # pin a request thread forever or poison this pool slot, so the
+            # process is killed (and restarted on next use) on timeout.
+            deadline = time.monotonic() + EXIFTOOL_TIMEOUT
+            fd = p.stdout.fileno()
+            buf = bytearray()
+            sel = selectors.DefaultSelector()
+            sel.register(fd, selectors.EVENT_READ)
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not sel.select(remaining):
+                        self._kill()
+                        raise OSError(f"exiftool timed out after {EXIFTOOL_TIMEOUT}s")
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        self._kill()
+                        raise OSError("exiftool daemon closed stdout")
+                    buf += chunk
+                    stripped = bytes(buf).rstrip()
+                    if stripped.endswith(b"{ready}"):
+                        return stripped[:-len(b"{ready}")]
+            finally:
+                sel.close()
+
+    def close(self):
+        with self._lock:
+            if self._proc is None:
+                return
+            try:
+                self._proc.stdin.write(b"-stay_open\nFalse\n")
+                self._proc.stdin.flush()
+                self._proc.wait(timeout=5)
+            except Exception:
+                self._kill()
+            self._proc = None
+
+class ExifToolPool:
+    """Fixed-size pool of ExifToolDaemon workers checked out per request."""
+    def __init__(self, size: int):
+        self._daemons = [ExifToolDaemon() for _ in range(max(1, size))]
+        self._q: "queue.Queue[ExifToolDaemon]" = queue.Queue()
+        for d in self._daemons:
+            self._q.put(d)
+
+    def get(self, file_path: str) -> dict:
+        d = self._q.get()
+        try:
+            out = d.query(file_path)
+        except OSError as e:
+            app.logger.warning("[exiftool] daemon error for %s: %s", file_path, e)
+            return {}
+        finally:
+            self._q.put(d)
+        try:
+            data = _json_loads(out)
+        except ValueError as e:
+            app.logger.warning("[exiftool] parse error for %s: %s", file_path, e)
             return {}
-        data = json.loads(proc.stdout)
         if isinstance(data, list) and data:
             return data[0]
         return {}
-    except (json.JSONDecodeError, subprocess.TimeoutExpired, OSError) as e:
-        app.logger.warning("[exiftool] parse error for %s: %s", file_path, e)
+
+    def close(self):
+        for d in self._daemons:
+            d.close()
+
+exiftool_pool = ExifToolPool(os.cpu_count() or 4)
+atexit.register(exiftool_pool.close)
+
+def get_exif_metadata(file_path: str) -> dict:
+    return exiftool_pool.get(file_path)
+
+EXIFTOOL_BATCH_CHUNK = 200
+
+def get_exif_metadata_batch(paths: List[str]) -> Dict[str, dict]:
+    """Read metadata for many files in chunked exiftool invocations.
+
+    One spawn per chunk amortizes startup; chunking keeps each JSON parse
+    (and its timeout) bounded instead of blocking on one multi-thousand-
+    file response. Returns {path: meta} keyed by exiftool's SourceFile
+    (the path exactly as given).
+    """
+    out: Dict[str, dict] = {}
+    for i in range(0, len(paths), EXIFTOOL_BATCH_CHUNK):
+        out.update(_get_exif_metadata_chunk(paths[i:i + EXIFTOOL_BATCH_CHUNK]))
+    return out
+
+def _get_exif_metadata_chunk(paths: List[str]) -> Dict[str, dict]:
+    # Paths go through a -@ argfile so the command line never hits ARG_MAX.
+    if not paths:
+        return {}
+    fd, listfile = tempfile.mkstemp(prefix="gallery-et-", suffix=".txt")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write("\n".join(paths))
+        cmd = ["exiftool", "-@", listfile] + EXIFTOOL_COMMON_ARGS + TAG_ARGS + ["-q", "-q"]
+        proc = subprocess.run(cmd, capture_output=True, timeout=max(60, len(paths)))
+        data = _json_loads(proc.stdout or b"[]")
+    except (ValueError, subprocess.TimeoutExpired, OSError) as e:
+        app.logger.warning("[exiftool] batch error for %d files: %s", len(paths), e)
         return {}
+    finally:
+        try:
+            os.unlink(listfile)
+        except OSError:
+            pass
+    out: Dict[str, dict] = {}
+    if isinstance(data, list):
+        for item in data:
+            src = item.get("SourceFile")
+            if src:
+                out[src] = item
+    return out
+
+def summaries_for(paths: List[str], mtimes: Optional[Dict[str, int]] = None) -> Dict[str, dict]:
+    """Summaries for all paths, with at most one stat per file.
+
+    The API routes already stat every file for the ETag; they pass that
+    {path: st_mtime_ns} map in so the freshness check here reuses it
+    instead of stat'ing again. Misses are fetched with the chunked batch
+    call, and anything the batch couldn't read falls back to the
+    stay_open pool.
+    """
+    if mtimes is None:
+        mtimes = {}
+    out: Dict[str, dict] = {}
+    missing: List[str] = []
+    for p in paths:
+        s = meta_cache.get_summary(p, mtimes.get(p))
+        if s is None:
+            missing.append(p)
+        else:
+            out[p] = s
+    if missing:
+        batch = get_exif_metadata_batch(missing)
+        for p in missing:
+            meta = batch.get(p)
+            if meta is None:
+                meta = get_exif_metadata(p)
+            meta_cache.set(p, meta)
+            s = meta_cache.get_summary(p)
+            out[p] = s if s is not None else summarize_meta(meta)
+    return out
 
 # ---------------------- Metadata cache ----------------------
 @dataclass
 class MetaCacheItem:
-    mtime: float
+    mtime_ns: int
     data: dict
+    summary: dict
     ts: float
 
 class MetaCache:
-    def __init__(self, ttl: int = CACHE_TTL_DEFAULT):
+    """In-memory metadata cache backed by a sqlite file.
+
+    The sqlite table persists entries across restarts keyed by
+    (path, mtime_ns, size); rows whose file changed or vanished are
+    dropped on load, so a warm start costs one stat per file instead of
+    a full exiftool re-scan.
+    """
+    def __init__(self, ttl: int = CACHE_TTL_DEFAULT, db_path: Optional[Path] = None):
         self.ttl = max(0, int(ttl))
         self._lock = threading.Lock()
         self._data: Dict[str, MetaCacheItem] = {}
-    def get(self, path: str) -> Optional[dict]:
-        p = str(Path(path).resolve())
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path is not None:
+            try:
+                db_path.parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS meta (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, data BLOB)")
+                self._db.commit()
+                self._load_db()
+            except sqlite3.Error as e:
+                app.logger.warning("[metacache] sqlite unavailable (%s); cache is memory-only", e)
+                self._db = None
+
+    def _load_db(self):
+        now = time.time()
+        stale = []
+        for path, mtime_ns, size, blob in self._db.execute("SELECT path, mtime_ns, size, data FROM meta"):
+            try:
+                st = os.stat(path)
+                if st.st_mtime_ns != mtime_ns or st.st_size != size:
+                    raise OSError("changed")
+                data = _json_loads(blob)
+                self._data[path] = MetaCacheItem(mtime_ns=mtime_ns, data=data, summary=summarize_meta(data), ts=now)
+            except (OSError, ValueError):
+                stale.append((path,))
+        if stale:
+            self._db.executemany("DELETE FROM meta WHERE path=?", stale)
+            self._db.commit()
+
+    def _db_delete(self, path: str):
+        if self._db is None: return
+        try:
+            self._db.execute("DELETE FROM meta WHERE path=?", (path,))
+            self._db.commit()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, path: str, drop_db: bool = True):
         with self._lock:
-            item = self._data.get(p)
-            if not item: return None
+            self._data.pop(path, None)
+            if drop_db:
+                self._db_delete(path)
+
+    def _get_item(self, path: str, mtime_ns: Optional[int] = None) -> Optional[MetaCacheItem]:
+        # Reads vastly outnumber writes, and a single dict lookup is atomic
+        # under CPython, so the hot path takes no lock; only eviction does.
+        # Callers pass the canonical strings scan_images produced; resolving
+        # again here would cost a realpath syscall chain per lookup.
+        # A caller that already stat'ed the file (the ETag pass) hands the
+        # mtime in so the freshness check costs no extra syscall.
+        p = str(path)
+        item = self._data.get(p)
+        if not item: return None
+        if mtime_ns is None:
             try:
-                mtime = os.path.getmtime(p)
+                mtime_ns = os.stat(p).st_mtime_ns
             except FileNotFoundError:
-                self._data.pop(p, None); return None
-            if mtime != item.mtime: self._data.pop(p, None); return None
-            if self.ttl and (time.time() - item.ts > self.ttl):
-                self._data.pop(p, None); return None
-            return item.data
+                self._evict(p); return None
+        if mtime_ns != item.mtime_ns:
+            self._evict(p); return None
+        if self.ttl and (time.time() - item.ts > self.ttl):
+            self._evict(p, drop_db=False); return None
+        return item
+
+    def get(self, path: str) -> Optional[dict]:
+        item = self._get_item(path)
+        return item.data if item else None
+
+    def get_summary(self, path: str, mtime_ns: Optional[int] = None) -> Optional[dict]:
+        item = self._get_item(path, mtime_ns)
+        return item.summary if item else None
+
+    def prune(self, keep: Set[str], prefix: str):
+        # Deleted/rotated files would otherwise keep their entries (and
+        # sqlite rows) forever; only paths under prefix are considered so
+        # one root's scan can't evict another's.
+        with self._lock:
+            dead = [k for k in self._data if k.startswith(prefix) and k not in keep]
+            for k in dead:
+                self._data.pop(k, None)
+                self._db_delete(k)
+
     def set(self, path: str, data: dict):
-        p = str(Path(path).resolve())
+        p = str(path)
         try:
-            mtime = os.path.getmtime(p)
+            st = os.stat(p)
         except FileNotFoundError:
             return
         with self._lock:
-            self._data[p] = MetaCacheItem(mtime=mtime, data=data, ts=time.time())
-
-meta_cache = MetaCache()
-
-# ---------------------- Ignore helpers ----------------------
-def should_ignore(path: Path) -> bool:
-    for part in path.parts:
-        if part.lower() in {d.lower() for d in IGNORE_DIRS}:
-            return True
-    name = path.name.lower()
-    for pat in IGNORE_GLOBS:
-        if fnmatch.fnmatch(name, pat.lower()):
-            return True
-    return False
+            self._data[p] = MetaCacheItem(mtime_ns=st.st_mtime_ns, data=data, summary=summarize_meta(data), ts=time.time())
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO meta (path, mtime_ns, size, data) VALUES (?,?,?,?)",
+                                     (p, st.st_mtime_ns, st.st_size, _json_dumps(data)))
+                    self._db.commit()
+                except sqlite3.Error:
+                    pass
 
 # ---------------------- Image scanning with de-dupe ---------
-def is_image(path: Path) -> bool:
-    return path.suffix.lower() in DEFAULT_EXTS
+# Scan results are cached per root so /thumb and /display don't re-walk the
+# tree on every hit. A snapshot of directory mtimes catches added/removed
+# files; the TTL bounds staleness for edits that don't touch dir mtimes.
+SCAN_CACHE_TTL = int(os.environ.get("GALLERY_SCAN_TTL", "30"))
+_scan_lock = threading.RLock()
+_scan_cache: Dict[str, Tuple[int, List[Path], float]] = {}
+
+def _scan_snapshot(root: Path) -> int:
+    try:
+        snap = os.stat(root).st_mtime_ns
+        with os.scandir(root) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    snap = max(snap, e.stat(follow_symlinks=False).st_mtime_ns)
+        return snap
+    except OSError:
+        return -1
+
+def invalidate_scan_cache():
+    with _scan_lock:
+        _scan_cache.clear()
 
 def scan_images(root: Path) -> List[Path]:
-    files: List[Path] = []
+    key = str(root)
+    snap = _scan_snapshot(root)
+    with _scan_lock:
+        cached = _scan_cache.get(key)
+        if cached and cached[0] == snap and (time.time() - cached[2]) <= SCAN_CACHE_TTL:
+            return cached[1]
+    files = _scan_images_uncached(root)
+    with _scan_lock:
+        _scan_cache[key] = (snap, files, time.time())
+    meta_cache.prune({str(p) for p in files}, key + os.sep)
+    return files
+
+def _scan_images_uncached(root: Path) -> List[Path]:
+    # Stack-based DFS over os.scandir: DirEntry carries type and stat info
+    # from readdir, so each file costs one stat instead of the three
+    # (resolve + stat + walk bookkeeping) the os.walk version paid.
+    files: List[str] = []
     seen: Set[str] = set()
     seen_inode: Set[Tuple[int,int]] = set()
-    for dirpath, dirnames, filenames in os.walk(root):
-        dirnames[:] = [d for d in dirnames if (Path(dirpath)/d).name.lower() not in {x.lower() for x in IGNORE_DIRS}]
-        for fn in filenames:
-            p = Path(dirpath) / fn
-            if should_ignore(p) or not is_image(p):
-                continue
-            try:
-                rp = str(p.resolve())
-            except Exception:
-                rp = str(p.absolute())
-            key = rp.lower()
-            if key in seen:
-                continue
-            try:
-                st = os.stat(rp)
-                tup = (getattr(st, "st_ino", 0), getattr(st, "st_dev", 0))
-                if tup in seen_inode:
+    stack = [str(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                name_low = e.name.lower()
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        if name_low not in _IGNORE_DIRS_LOWER:
+                            stack.append(e.path)
+                        continue
+                    if not e.is_file():
+                        continue
+                except OSError:
                     continue
-                seen_inode.add(tup)
-            except Exception:
-                pass
-            seen.add(key)
-            files.append(Path(rp))
-    files.sort(key=lambda p: str(p).lower())
-    return files
+                dot = name_low.rfind(".")
+                if dot < 0 or name_low[dot:] not in DEFAULT_EXTS:
+                    continue
+                if _IGNORE_RE.match(name_low):
+                    continue
+                key = os.path.abspath(e.path).lower()
+                if key in seen:
+                    continue
+                try:
+                    st = e.stat()
+                    tup = (getattr(st, "st_ino", 0), getattr(st, "st_dev", 0))
+                    if tup in seen_inode:
+                        continue
+                    seen_inode.add(tup)
+                except OSError:
+                    pass
+                seen.add(key)
+                files.append(e.path)
+    files.sort(key=str.lower)
+    return [Path(f) for f in files]
 
 # ---------------------- Summarization + state/season --------
 KEYS_STRING = ["FileName","Directory","MIMEType","Model","Make","LensModel","Artist","Creator","Title","Headline","Description","Subject","Keywords","Location","City","State","Province-State","Country"]
 KEYS_NUM = ["ImageWidth","ImageHeight","Orientation","FocalLength","FNumber","ShutterSpeedValue","ExposureTime","ISO","GPSLatitude","GPSLongitude"]
 KEYS_TIME = ["CreateDate","DateTimeOriginal"]
 
+# Only the tags summarize_meta consumes — a full dump drags megabytes of
+# MakerNotes JSON through IPC for RAW/HEIC sources just to be discarded.
+TAG_ARGS = ["-" + k for k in KEYS_STRING + KEYS_NUM + KEYS_TIME] + ["-SourceFile"]
+
+_CTRL_RE = re.compile(r"[\r\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# The same few hundred unique State/Keywords strings repeat across
+# thousands of files, so both normalizers memoize on their primitive input.
+@functools.lru_cache(maxsize=4096)
+def _normalize_state_value(raw: str) -> str:
+    s = raw.strip()
+    if len(s) == 2 and s.isalpha():
+        abbr = s.upper()
+        return US_ABBR_TO_FULL.get(abbr, abbr)
+    low = s.lower()
+    if low in US_FULL_TO_ABBR:
+        return " ".join(w.capitalize() for w in low.split())
+    return s.title()
+
 def normalize_state_full(meta: dict) -> Optional[str]:
     for k in ("State","Province-State"):
         raw = meta.get(k)
-        if not raw: continue
-        s = str(raw).strip()
-        if len(s) == 2 and s.isalpha():
-            abbr = s.upper()
-            return US_ABBR_TO_FULL.get(abbr, abbr)
-        low = s.lower()
-        if low in US_FULL_TO_ABBR:
-            return " ".join(w.capitalize() for w in low.split())
-        return s.title()
+        if raw:
+            return _normalize_state_value(str(raw))
     return None
 
-def parse_season(meta: dict) -> Optional[str]:
-    kw = meta.get("Keywords") or ""
-    if isinstance(kw, list): kw_list = kw
-    else: kw_list = [x.strip() for x in str(kw).split(",")]
-    for k in kw_list:
+@functools.lru_cache(maxsize=4096)
+def _parse_season_keywords(kw_tuple: Tuple[str, ...]) -> Optional[str]:
+    for k in kw_tuple:
         k_low = k.lower()
         if k_low.startswith("season:"):
             v = k_low.split(":",1)[1]
@@ -196,6 +527,12 @@ def parse_season(meta: dict) -> Optional[str]:
             return v
     return None
 
+def parse_season(meta: dict) -> Optional[str]:
+    kw = meta.get("Keywords") or ""
+    if isinstance(kw, list): kw_tuple = tuple(str(x) for x in kw)
+    else: kw_tuple = tuple(x.strip() for x in str(kw).split(","))
+    return _parse_season_keywords(kw_tuple)
+
 def summarize_meta(meta: dict) -> dict:
     if not meta: return {}
     out = {}
@@ -203,7 +540,7 @@ def summarize_meta(meta: dict) -> dict:
         v = meta.get(k)
         if v is None: continue
         if isinstance(v, str):
-            v = re.sub(r"[\r\x00-\x08\x0b\x0c\x0e-\x1f]", " ", v).strip()
+            v = _CTRL_RE.sub(" ", v).strip()
         out[k] = v
     for k in KEYS_NUM:
         v = meta.get(k)
@@ -215,41 +552,123 @@ def summarize_meta(meta: dict) -> dict:
     w = out.get("ImageWidth"); h = out.get("ImageHeight")
     if isinstance(w,(int,float)) and isinstance(h,(int,float)) and w and h:
         out["_orientation"] = "portrait" if h > w else ("landscape" if w > h else "square")
+        out["_too_small"] = max(w,h) < MIN_LONG
     st = normalize_state_full(out)
     if st: out["_state"] = st
     ss = parse_season(out)
     if ss: out["_season"] = ss
     return out
 
+# Instantiated here, not next to the class: _load_db summarizes every
+# persisted row, so summarize_meta and friends must already exist.
+meta_cache = MetaCache(db_path=META_DB_PATH)
+
+# ---------------------- Facet index -------------------------
+class FacetIndex:
+    """Inverted index {state -> paths} / {season -> paths} over one scan.
+
+    Rebuilt lazily whenever scan_images hands back a fresh list, so
+    filtered /api/images requests walk only the matching subset instead
+    of summarizing the whole gallery.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: Optional[List[Path]] = None
+        self.by_state: Dict[str, List[str]] = {}
+        self.by_season: Dict[str, List[str]] = {}
+
+    def ensure(self, files: List[Path], summaries: Optional[Dict[str, dict]] = None,
+               mtimes: Optional[Dict[str, int]] = None) -> "FacetIndex":
+        with self._lock:
+            if files is self._files:
+                return self
+        if summaries is None:
+            summaries = summaries_for([str(p) for p in files], mtimes)
+        by_state: Dict[str, List[str]] = {}
+        by_season: Dict[str, List[str]] = {}
+        for p_str, summary in summaries.items():
+            if summary.get("_too_small"):
+                continue
+            st = summary.get("_state")
+            if st: by_state.setdefault(st, []).append(p_str)
+            ss = summary.get("_season")
+            if ss: by_season.setdefault(ss, []).append(p_str)
+        with self._lock:
+            self._files = files
+            self.by_state = by_state
+            self.by_season = by_season
+        return self
+
+    def candidates(self, state: Optional[str], season: Optional[str]) -> List[str]:
+        if state and season:
+            pool = set(self.by_state.get(state, ()))
+            return [p for p in self.by_season.get(season, ()) if p in pool]
+        if state:
+            return list(self.by_state.get(state, ()))
+        return list(self.by_season.get(season, ()))
+
+facet_index = FacetIndex()
+
 # ---------------------- Cache keys --------------------------
-def sha_for(src: Path, extra: str) -> str:
-    st = src.stat()
+@functools.lru_cache(maxsize=65536)
+def _sha_for_key(resolved: str, mtime_ns: int, size: int, extra: str) -> str:
     h = hashlib.sha1()
-    h.update(str(src.resolve()).encode("utf-8"))
-    h.update(str(st.st_mtime_ns).encode("utf-8"))
-    h.update(str(st.st_size).encode("utf-8"))
+    h.update(resolved.encode("utf-8"))
+    h.update(str(mtime_ns).encode("utf-8"))
+    h.update(str(size).encode("utf-8"))
     h.update(extra.encode("utf-8"))
     return h.hexdigest()
 
-def thumb_cache_path(src: Path, w: int, fmt: str) -> Path:
+def sha_for(src: Path, extra: str) -> str:
+    # The stat stays outside the memoized part so a touched file changes
+    # the key (and the digest) instead of hitting a stale cache entry.
+    st = src.stat()
+    return _sha_for_key(str(src.resolve()), st.st_mtime_ns, st.st_size, extra)
+
+def thumb_cache_path(src: Path, w: int, fmt: str) -> Tuple[Path, str]:
     digest = sha_for(src, f"thumb:{w}:{fmt}")
     sub = digest[:2] + "/" + digest[2:]
-    return CACHE_DIR_THUMBS / sub / f"thumb.{fmt}"
+    return CACHE_DIR_THUMBS / sub / f"thumb.{fmt}", digest
 
-def display_cache_path(src: Path, max_long: int, fmt: str, hdr: bool) -> Path:
+def display_cache_path(src: Path, max_long: int, fmt: str, hdr: bool) -> Tuple[Path, str]:
     digest = sha_for(src, f"display:{max_long}:{fmt}:hdr={int(hdr)}")
     sub = digest[:2] + "/" + digest[2:]
-    return CACHE_DIR_DISPLAY / sub / f"display.{fmt}"
+    return CACHE_DIR_DISPLAY / sub / f"display.{fmt}", digest
 
 # ---------------------- Resizing ----------------------------
+def _vips_thumbnail(src_path: Path, dst: Path, long_side: int, fmt: str, quality: int) -> bool:
+    try:
+        im = pyvips.Image.thumbnail(str(src_path), long_side, height=long_side, size="down")
+        if fmt == "avif":
+            im.write_to_file(str(dst), Q=quality)
+        else:
+            im.write_to_file(str(dst), Q=quality, effort=6)
+        return True
+    except Exception as e:
+        app.logger.warning("[pyvips] thumbnail failed for %s, falling back to Pillow: %s", src_path, e)
+        try:
+            dst.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return False
+
 def make_thumbnail(src_path: Path, w: int, fmt: str):
     from PIL import Image
-    dst = thumb_cache_path(src_path, w, fmt)
+    dst, digest = thumb_cache_path(src_path, w, fmt)
     dst.parent.mkdir(parents=True, exist_ok=True)
     if dst.exists():
         mime = "image/avif" if fmt == "avif" else "image/webp"
-        return dst, mime
+        return dst, mime, digest
+    if PYVIPS_ENABLED:
+        quality = int(os.environ.get("GALLERY_AVIF_QUALITY" if fmt == "avif" else "GALLERY_WEBP_QUALITY", "82"))
+        if _vips_thumbnail(src_path, dst, w, fmt, quality):
+            mime = "image/avif" if fmt == "avif" else "image/webp"
+            return dst, mime, digest
     with Image.open(src_path) as im:
+        if im.format == "JPEG":
+            # libjpeg can downscale in the DCT domain (1/2, 1/4, 1/8) while
+            # decoding; 2x the target leaves headroom for the LANCZOS pass.
+            im.draft("RGB", (w * 2, w * 2))
         im = ImageOps.exif_transpose(im)
         if im.mode not in ("RGB","RGBA"): im = im.convert("RGB")
         ratio = w / max(im.width, im.height)
@@ -261,16 +680,24 @@ def make_thumbnail(src_path: Path, w: int, fmt: str):
         else:
             im.save(dst, "WEBP", method=6, quality=int(os.environ.get("GALLERY_WEBP_QUALITY", "82")))
             mime = "image/webp"
-    return dst, mime
+    return dst, mime, digest
 
 def make_display(src_path: Path, max_long: int, fmt: str, hdr: bool):
     from PIL import Image
-    dst = display_cache_path(src_path, max_long, fmt, hdr)
+    dst, digest = display_cache_path(src_path, max_long, fmt, hdr)
     dst.parent.mkdir(parents=True, exist_ok=True)
     if dst.exists():
         mime = "image/avif" if fmt == "avif" else "image/webp"
-        return dst, mime
+        return dst, mime, digest
+    # HDR stays on the Pillow/pillow-avif path, which owns the 10-bit save.
+    if PYVIPS_ENABLED and not hdr:
+        quality = int(os.environ.get("GALLERY_AVIF_QUALITY" if fmt == "avif" else "GALLERY_WEBP_QUALITY", "90"))
+        if _vips_thumbnail(src_path, dst, max_long, fmt, quality):
+            mime = "image/avif" if fmt == "avif" else "image/webp"
+            return dst, mime, digest
     with Image.open(src_path) as im:
+        if im.format == "JPEG":
+            im.draft("RGB", (max_long * 2, max_long * 2))
         im = ImageOps.exif_transpose(im)
         long_side = max(im.width, im.height)
         ratio = max_long / long_side if long_side else 1.0
@@ -295,41 +722,63 @@ def make_display(src_path: Path, max_long: int, fmt: str, hdr: bool):
             im = im.convert("RGB")
             im.save(dst, "WEBP", method=6, quality=int(os.environ.get("GALLERY_WEBP_QUALITY", "90")))
             mime = "image/webp"
-    return dst, mime
+    return dst, mime, digest
 
 # ---------------------- Prebuild ----------------------------
-def prebuild_all(images: List[Path], sizes: List[int], max_long: int, build_avif: bool, build_hdr: bool):
-    app.logger.info("Prebuild start: %d images, thumbs=%s, display=%d, avif=%s, hdr=%s",
-                    len(images), sizes, max_long, build_avif, build_hdr)
-    def work(p: Path):
-        # skip tiny
+def _prebuild_one(p: Path, sizes: List[int], max_long: int, build_avif: bool, build_hdr: bool,
+                  skip_size_check: bool = False) -> int:
+    # skip tiny (only probed here when exiftool didn't report dimensions)
+    if not skip_size_check:
         try:
             with Image.open(p) as im:
                 if max(im.width, im.height) < MIN_LONG:
                     return 0
         except Exception:
             return 0
-        made = 0
-        # thumbs (SDR only)
-        for fmt in (["avif","webp"] if (build_avif and AVIF_ENABLED) else ["webp"]):
-            for w in sizes:
-                make_thumbnail(p, w, fmt); made += 1
-        # display (SDR + optional HDR AVIF)
-        for fmt in (["avif","webp"] if (build_avif and AVIF_ENABLED) else ["webp"]):
-            make_display(p, max_long, fmt, hdr=False); made += 1
-        if build_hdr and AVIF_ENABLED:
-            make_display(p, max_long, "avif", hdr=True); made += 1
-        return made
+    made = 0
+    # thumbs (SDR only)
+    for fmt in (["avif","webp"] if (build_avif and AVIF_ENABLED) else ["webp"]):
+        for w in sizes:
+            make_thumbnail(p, w, fmt); made += 1
+    # display (SDR + optional HDR AVIF)
+    for fmt in (["avif","webp"] if (build_avif and AVIF_ENABLED) else ["webp"]):
+        make_display(p, max_long, fmt, hdr=False); made += 1
+    if build_hdr and AVIF_ENABLED:
+        make_display(p, max_long, "avif", hdr=True); made += 1
+    return made
+
+def prebuild_all(images: List[Path], sizes: List[int], max_long: int, build_avif: bool, build_hdr: bool):
+    app.logger.info("Prebuild start: %d images, thumbs=%s, display=%d, avif=%s, hdr=%s",
+                    len(images), sizes, max_long, build_avif, build_hdr)
+    # The size cut comes from the exiftool batch (ImageWidth/ImageHeight
+    # are cheap tags) so workers don't decode every file once just to
+    # measure it and a second time to resize it. Files exiftool couldn't
+    # size keep the in-worker Pillow probe.
+    summaries = summaries_for([str(p) for p in images])
+    jobs: List[Tuple[Path, bool]] = []
+    for p in images:
+        summary = summaries.get(str(p)) or {}
+        if "_too_small" in summary:
+            if summary["_too_small"]:
+                continue
+            jobs.append((p, True))
+        else:
+            jobs.append((p, False))
 
     total = 0
-    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 4)) as ex:
-        futures = [ex.submit(work, p) for p in images]
+    # Decode+resize is CPU-bound and Pillow holds the GIL for parts of it,
+    # so run one worker process per core. Encoding stays in-worker; results
+    # land on disk, so only the made-count crosses the pickle boundary.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futures = [ex.submit(_prebuild_one, p, sizes, max_long, build_avif, build_hdr, skip_size_check)
+                   for p, skip_size_check in jobs]
         for f in as_completed(futures):
             try:
                 total += f.result()
             except Exception as e:
                 app.logger.warning("Prebuild error: %s", e)
     app.logger.info("Prebuild done. Items generated: %d", total)
+    invalidate_scan_cache()
 
 # ---------------------- Routes ------------------------------
 IMAGES_DIR = Path(os.environ.get("GALLERY_IMAGES_DIR", ".")).resolve()
@@ -340,64 +789,102 @@ def set_images_dir(p: Path):
 
 @app.get("/")
 def index():
-    return send_from_directory(str(Path(__file__).parent), "index.html")
+    return send_from_directory(str(APP_DIR), "index.html")
 
 @app.route("/static/<path:filename>")
 def static_files(filename):
-    return send_from_directory(str(Path(__file__).parent / "static"), filename)
+    return send_from_directory(str(STATIC_DIR), filename)
 
 @app.get("/api/ping")
 def ping():
     return jsonify({"ok": True, "images_dir": str(IMAGES_DIR), "avif": AVIF_ENABLED, "min_long": MIN_LONG, "version": "v0.2.8"})
 
+def _gallery_etag(files: List[Path]) -> Tuple[str, Dict[str, int]]:
+    """Weak-ish content key for the metadata endpoints: any file added,
+    removed, or touched changes it. Also returns the {path: st_mtime_ns}
+    map so callers can reuse this stat pass for cache freshness checks."""
+    h = hashlib.sha1()
+    mtimes: Dict[str, int] = {}
+    for p in files:
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        p_str = str(p)
+        mtimes[p_str] = st.st_mtime_ns
+        h.update(p_str.encode("utf-8"))
+        h.update(str(st.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest(), mtimes
+
 @app.get("/api/images")
 def api_images():
     season = (request.args.get("season") or "").strip().lower()
     state = (request.args.get("state") or "").strip()
 
     files = scan_images(IMAGES_DIR)
-    results = []
-    for p in files:
-        p_str = str(p)
-        meta = meta_cache.get(p_str)
-        if meta is None:
-            meta = get_exif_metadata(p_str)
-            meta_cache.set(p_str, meta)
-        summary = summarize_meta(meta)
-        summary["_path"] = str(Path(p).relative_to(IMAGES_DIR))
-        summary["_name"] = Path(p).name
-
-        w = int(summary.get("ImageWidth") or 0); h = int(summary.get("ImageHeight") or 0)
-        if max(w,h) and max(w,h) < MIN_LONG:
-            continue
-
-        if season and season != (summary.get("_season","") or "").lower():
-            continue
-        if state and state != (summary.get("_state","") or ""):
-            continue
+    etag, mtimes = _gallery_etag(files)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    summaries = summaries_for([str(p) for p in files], mtimes)
+    if season or state:
+        candidates = facet_index.ensure(files, summaries).candidates(state or None, season or None)
+    else:
+        # Scan order, not dict order: summaries_for lists hits before
+        # misses, which would reshuffle the grid while files are added.
+        candidates = [str(p) for p in files]
+    # Stream item-by-item instead of materializing the whole list: the
+    # browser starts rendering sooner and peak memory stays flat. The
+    # total isn't known up front, so it trails the items array.
+    def generate():
+        yield b'{"items":['
+        total = 0
+        for p_str in candidates:
+            summary = summaries.get(p_str)
+            if summary is None or summary.get("_too_small"):
+                continue
+            summary = dict(summary)  # cached dict must not pick up _path/_name
+            summary.pop("_too_small", None)
+            summary["_path"] = str(Path(p_str).relative_to(IMAGES_DIR))
+            summary["_name"] = Path(p_str).name
 
-        results.append(summary)
+            yield (b"," if total else b"") + _json_dumps(summary)
+            total += 1
+        yield b'],"total":%d}' % total
 
-    return jsonify({"total": len(results), "items": results})
+    resp = Response(stream_with_context(generate()), mimetype="application/json")
+    resp.set_etag(etag)
+    return resp
 
 @app.get("/api/facets")
 def api_facets():
     files = scan_images(IMAGES_DIR)
-    states = set(); seasons = set()
-    for p in files:
-        meta = meta_cache.get(str(p))
-        if meta is None:
-            meta = get_exif_metadata(str(p))
-            meta_cache.set(str(p), meta)
-        summary = summarize_meta(meta)
-        w = int(summary.get("ImageWidth") or 0); h = int(summary.get("ImageHeight") or 0)
-        if max(w,h) and max(w,h) < MIN_LONG:
-            continue
-        st = summary.get("_state")
-        if st: states.add(st)
-        ss = summary.get("_season")
-        if ss: seasons.add(ss)
-    return jsonify({"states": sorted(states), "seasons": sorted(seasons)})
+    etag, mtimes = _gallery_etag(files)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    index = facet_index.ensure(files, mtimes=mtimes)
+    payload = {"states": sorted(index.by_state), "seasons": sorted(index.by_season)}
+    resp = Response(_json_dumps(payload), mimetype="application/json")
+    resp.set_etag(etag)
+    return resp
+
+def _cached_image_response(dst: Path, mime: str, digest: str):
+    # Cache entries are content-addressed (sha1 of source path+mtime+size),
+    # so the bytes behind a given digest never change: tell the browser to
+    # keep them forever instead of revalidating on every reload.
+    if ACCEL_PREFIX:
+        resp = Response(b"", mimetype=mime)
+        resp.headers["X-Accel-Redirect"] = ACCEL_PREFIX + "/" + dst.relative_to(CACHE_DIR).as_posix()
+    else:
+        # send_file hands the open file to wsgi.file_wrapper, so a real
+        # WSGI server (gunicorn/uwsgi) can use sendfile(2) for the body.
+        resp = send_file(str(dst), mimetype=mime, conditional=True)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    resp.set_etag(digest)
+    return resp.make_conditional(request)
 
 @app.get("/thumb")
 def thumb():
@@ -408,12 +895,11 @@ def thumb():
         abort(400, f"Unsupported w. Choose one of {THUMB_SIZES}")
     if not rel: abort(400, "Missing 'path'")
     src = (IMAGES_DIR / rel).resolve()
-    try: src.relative_to(IMAGES_DIR)
-    except Exception: abort(400, "Invalid path")
+    if not src.is_relative_to(IMAGES_DIR): abort(400, "Invalid path")
     if not src.exists(): abort(404)
     if fmt == "avif" and not AVIF_ENABLED: fmt = "webp"
-    dst, mime = make_thumbnail(src, w, fmt)
-    return send_file(str(dst), mimetype=mime, conditional=True)
+    dst, mime, digest = make_thumbnail(src, w, fmt)
+    return _cached_image_response(dst, mime, digest)
 
 @app.get("/display")
 def display():
@@ -423,13 +909,12 @@ def display():
     hdr = request.args.get("hdr") in ("1","true","yes")
     if not rel: abort(400, "Missing 'path'")
     src = (IMAGES_DIR / rel).resolve()
-    try: src.relative_to(IMAGES_DIR)
-    except Exception: abort(400, "Invalid path")
+    if not src.is_relative_to(IMAGES_DIR): abort(400, "Invalid path")
     if not src.exists(): abort(404)
     if fmt == "avif" and not AVIF_ENABLED:
         fmt = "webp"; hdr = False
-    dst, mime = make_display(src, max_long, fmt, hdr)
-    return send_file(str(dst), mimetype=mime, conditional=True)
+    dst, mime, digest = make_display(src, max_long, fmt, hdr)
+    return _cached_image_response(dst, mime, digest)
 
 def parse_args(argv: List[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Gallery v0.2.8")